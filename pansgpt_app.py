@@ -1,13 +1,25 @@
 import streamlit as st
 import os
-import sys
-import subprocess
 import time
 import base64
+import hashlib
+import asyncio
+import functools
+import io
+import json
 import requests
-import re # Added for parsing image URLs during deletion
+import shutil
+import tempfile
+import uuid
+import re # Parses image URLs out of older documents during deletion
+import multiprocessing
+import threading
+from collections import OrderedDict
 import fitz  # PyMuPDF
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from PIL import Image
 from datetime import datetime
+from pdf_extract import extract_page, extract_page_range
 
 # --- SETUP PAGE CONFIG ---
 st.set_page_config(
@@ -16,26 +28,12 @@ st.set_page_config(
     layout="wide"
 )
 
-# --- HELPER: INSTALL PACKAGES ---
-def install_package(package_name):
-    try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package_name])
-    except subprocess.CalledProcessError:
-        pass
-
 # --- IMPORTS ---
-try:
-    from dotenv import load_dotenv
-    from groq import Groq
-    from supabase import create_client, Client
-except ImportError:
-    # If on cloud and missing packages, this catches it, though requirements.txt handles it mostly
-    install_package("python-dotenv")
-    install_package("groq")
-    install_package("supabase")
-    from dotenv import load_dotenv
-    from groq import Groq
-    from supabase import create_client, Client
+# Dependencies come from requirements.txt; a missing package should fail loudly at deploy, not pip-install on startup
+from dotenv import load_dotenv
+import httpx
+from groq import AsyncGroq, Groq
+from supabase import create_client, Client
 
 load_dotenv()
 
@@ -56,23 +54,141 @@ SUPABASE_URL = get_secret("SUPABASE_URL")
 SUPABASE_KEY = get_secret("SUPABASE_SERVICE_ROLE_KEY")
 SUPABASE_BUCKET = "lecture-images"
 
+# Vision fan-out: max in-flight Groq calls, and start delay between the first wave
+VISION_CONCURRENCY = 10
+VISION_STAGGER_SECONDS = 0.05
+VISION_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+VISION_MAX_EDGE = 1024 # px, long edge of the image we send to Groq
+VISION_JPEG_QUALITY = 85
+
+# Hashes per vision_cache lookup: .in_() puts them all in the URL (~65 chars each), which proxies cap
+CACHE_LOOKUP_BATCH = 50
+
+# Descriptions kept in memory per process (least recently used go first); vision_cache holds the rest
+DESCRIPTION_MEMO_SIZE = 2000
+
+# Batch mode: send all vision calls through Groq's Batch API (50% cheaper, slower).
+# Off by default so interactive uploads keep using the sync path.
+BATCH_MODE = str(get_secret("PANSGPT_BATCH") or "0") == "1"
+BATCH_POLL_SECONDS = 30
+
+# Storage uploads run in a thread pool over one keep-alive session
+UPLOAD_WORKERS = 8
+UPLOAD_SPOOL_CHUNK = 1024 * 1024 # bytes per copy when writing the uploaded PDF to disk
+
+# Page extraction: per-page cost runs from ~1ms (text) to ~50ms (PNG-heavy), and a spawned worker
+# takes ~0.4s just to start and import fitz + PIL. So rather than count pages, we time the first few
+# in-process and only split the rest across workers when it would take longer than this serially.
+PARALLEL_SAMPLE_PAGES = 8
+PARALLEL_MIN_SECONDS = 2.0
+EXTRACT_MAX_WORKERS = 8
+
 # Initialize Clients
-if GROQ_API_KEY:
-    groq_client = Groq(api_key=GROQ_API_KEY)
+# Cached as resources so they (and their connection pools) survive reruns instead of being rebuilt each time
+@st.cache_resource(show_spinner=False)
+def get_groq():
+    if not GROQ_API_KEY:
+        return None
+    # The SDK retries 429s/5xx itself with exponential backoff (honours Retry-After)
+    return Groq(api_key=GROQ_API_KEY, max_retries=5)
+
+@st.cache_resource(show_spinner=False)
+def get_vision_loop():
+    """Long-lived event loop on a daemon thread that every upload's vision fan-out runs on.
+    An async client's pool is bound to the loop it first ran on, so a fresh asyncio.run() per upload can't share one."""
+    loop = asyncio.new_event_loop()
+    # to_thread's default pool is only cpu_count+4 threads, which would cap us below VISION_CONCURRENCY
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=VISION_CONCURRENCY))
+    threading.Thread(target=loop.run_forever, name="vision-loop", daemon=True).start()
+    return loop
 
-supabase: Client = None
-if SUPABASE_URL and SUPABASE_KEY:
+@st.cache_resource(show_spinner=False)
+def get_async_groq():
+    if not GROQ_API_KEY:
+        return None
+    # One HTTP/2 pool sized for the fan-out, so the TLS handshake is paid once per process rather than per call
+    http_client = httpx.AsyncClient(
+        http2=True,
+        # keepalive_expiry: httpx drops idle connections after 5s by default, shorter than a big deck's extraction
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60.0),
+        timeout=60.0,
+    )
+    return AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client, max_retries=5)
+
+async def warm_up_groq(client):
+    """Cheap GET that opens (or reuses) the pooled connection, so the TLS + HTTP/2 setup overlaps extraction
+    instead of the first vision wave. Failure just means the first call pays for it."""
     try:
-        supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+        await client.with_options(max_retries=0).models.list()
+    except Exception as e:
+        print(f"Groq warm-up warning: {e}")
+
+@st.cache_resource(show_spinner=False)
+def get_description_memo():
+    """Process-wide LRU of {image hash: description}, so re-uploads skip even the vision_cache lookup.
+    Shared by every session's script thread, hence the lock."""
+    return OrderedDict(), threading.Lock()
+
+def recall_descriptions(image_hashes):
+    """Memoised descriptions for these hashes ({hash: description}), marking them recently used"""
+    memo, lock = get_description_memo()
+    with lock:
+        found = {}
+        for image_hash in image_hashes:
+            if image_hash in memo:
+                memo.move_to_end(image_hash)
+                found[image_hash] = memo[image_hash]
+        return found
+
+def memoise_descriptions(descriptions):
+    """Adds {hash: description} to the memo, evicting the least recently used past DESCRIPTION_MEMO_SIZE"""
+    memo, lock = get_description_memo()
+    with lock:
+        for image_hash, description in descriptions.items():
+            memo[image_hash] = description
+            memo.move_to_end(image_hash)
+        while len(memo) > DESCRIPTION_MEMO_SIZE:
+            memo.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_supabase() -> Client:
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        return None
+    try:
+        return create_client(SUPABASE_URL, SUPABASE_KEY)
     except Exception as e:
         st.error(f"Supabase Connection Error: {e}")
+        return None
+
+@st.cache_resource(show_spinner=False)
+def get_storage_session():
+    # One session for all Storage uploads so TCP/TLS connections get reused
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=UPLOAD_WORKERS))
+    if SUPABASE_KEY:
+        session.headers.update({"Authorization": f"Bearer {SUPABASE_KEY}"})
+    return session
 
 # --- DATABASE FUNCTIONS ---
 
-def log_upload_to_db(filename, subject, processed_text):
-    """Saves the metadata AND content of the processed file to Supabase DB"""
+def storage_path_from_url(url):
+    """Object path inside our bucket for a public Storage URL (None if it's not ours)"""
+    if url and f"/{SUPABASE_BUCKET}/" in url:
+        return url.split(f"/{SUPABASE_BUCKET}/")[-1]
+    return None
+
+def read_document_text(row):
+    """Processed text for a documents row: from Storage (content_url), or the legacy content column"""
+    path = storage_path_from_url(row.get("content_url"))
+    if path:
+        return get_supabase().storage.from_(SUPABASE_BUCKET).download(path).decode("utf-8")
+    return row.get("content") or ""
+
+def log_upload_to_db(filename, subject, processed_text, page_count, image_urls):
+    """Saves the processed text to Storage and its metadata to Supabase DB. Returns True if both were saved."""
+    supabase = get_supabase()
     if not supabase:
-        return
+        return False
     
     # REQUIRED SQL SETUP IN SUPABASE:
     # CREATE TABLE documents (
@@ -81,71 +197,153 @@ def log_upload_to_db(filename, subject, processed_text):
     #   filename TEXT,
     #   subject TEXT,
     #   status TEXT DEFAULT 'processed',
-    #   content TEXT  <-- NEW COLUMN REQUIRED
+    #   content TEXT  <-- legacy, only read for old rows
     # );
+    # ALTER TABLE documents ADD COLUMN page_count INT;  <-- no backfill: legacy text has no page breaks to count,
+    #                                                        so old rows stay NULL and the library just omits it
+    # ALTER TABLE documents ADD COLUMN content_url TEXT;
+    # ALTER TABLE documents ADD COLUMN image_urls JSONB;
+
+    # The text itself lives in Storage; the row only keeps a pointer, so list queries stay tiny
+    content_path = f"content/{uuid.uuid4()}.txt"
+    try:
+        supabase.storage.from_(SUPABASE_BUCKET).upload(
+            content_path,
+            processed_text.encode("utf-8"),
+            {"content-type": "text/plain; charset=utf-8"},
+        )
+    except Exception as e:
+        st.warning(f"Could not save processed text: {e}")
+        return False
     
     data = {
         "filename": filename,
         "subject": subject,
         "status": "processed",
-        "content": processed_text, # Saving the actual text now
+        "content_url": f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{content_path}",
+        "page_count": page_count,
+        "image_urls": image_urls, # so delete doesn't have to parse them back out of the text
         "created_at": datetime.utcnow().isoformat()
     }
     
     try:
         supabase.table("documents").insert(data).execute()
+        get_upload_history.clear()
+        return True
     except Exception as e:
         st.warning(f"Could not save to history log: {e}")
+        return False
 
-def delete_document(doc_id):
-    """Deletes a document AND its associated images from Storage"""
-    if not supabase:
+def delete_documents(doc_ids):
+    """Deletes documents AND their associated images from Storage.
+    Batched: one query to find the files, one Storage call, one delete - however many documents."""
+    supabase = get_supabase()
+    if not supabase or not doc_ids:
         return
     
-    # 1. Fetch content to find linked images before deleting the record
+    # 1. Find linked images before deleting the records
     try:
-        response = supabase.table("documents").select("content").eq("id", doc_id).execute()
-        if response.data:
-            content = response.data[0].get("content", "")
-            
-            # Find URLs that match our bucket pattern
-            # Matches: url=".../lecture-images/filename.png"
-            urls = re.findall(r'url="([^"]+)"', content)
+        # content is only filled on older rows, so selecting it is cheap for new ones
+        response = supabase.table("documents").select("content, content_url, image_urls").in_("id", doc_ids).execute()
+
+        files_to_remove = []
+        for row in response.data:
+            urls = row.get("image_urls")
+            if isinstance(urls, str): # column created as TEXT rather than JSONB
+                urls = json.loads(urls)
+
+            if urls is None:
+                # Older rows have no image_urls: scan the text for url="..." tokens instead
+                urls = re.findall(r'url="([^"]+)"', read_document_text(row))
             
-            files_to_remove = []
             for url in urls:
                 # Check if URL belongs to our bucket
-                if f"/{SUPABASE_BUCKET}/" in url:
-                    # Extract filename: last part of URL after bucket name
-                    filename = url.split(f"/{SUPABASE_BUCKET}/")[-1]
+                filename = storage_path_from_url(url)
+                if filename:
                     files_to_remove.append(filename)
+
+            # The processed text file itself
+            content_path = storage_path_from_url(row.get("content_url"))
+            if content_path:
+                files_to_remove.append(content_path)
             
-            # Remove images from Supabase Storage
-            if files_to_remove:
-                # Supabase storage.remove expects a list of file paths
-                supabase.storage.from_(SUPABASE_BUCKET).remove(files_to_remove)
+        # Remove images from Supabase Storage
+        if files_to_remove:
+            # Supabase storage.remove expects a list of file paths
+            supabase.storage.from_(SUPABASE_BUCKET).remove(files_to_remove)
                 
     except Exception as e:
         # Just warn, don't stop the DB deletion if image cleanup fails
         print(f"Image cleanup warning: {e}")
 
-    # 2. Delete the database record
+    # 2. Delete the database records
     try:
-        supabase.table("documents").delete().eq("id", doc_id).execute()
-        st.toast("Document and images deleted successfully!", icon="🗑️")
+        supabase.table("documents").delete().in_("id", doc_ids).execute()
+        get_upload_history.clear()
+        for doc_id in doc_ids:
+            get_document_content.clear(doc_id)
+        noun = "Document" if len(doc_ids) == 1 else f"{len(doc_ids)} documents"
+        st.toast(f"{noun} and images deleted successfully!", icon="🗑️")
     except Exception as e:
         st.error(f"Could not delete document: {e}")
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_upload_history():
-    """Fetches list of uploaded docs"""
+    """Fetches list of uploaded docs (metadata only, content is fetched on download).
+    Errors propagate so they aren't cached; the caller reports them."""
+    supabase = get_supabase()
     if not supabase:
         return []
+    # Skip the content column here: it's MBs per lecture and the list doesn't need it. Limit to last 50
+    response = supabase.table("documents").select("id, filename, subject, created_at, page_count").order("created_at", desc=True).limit(50).execute()
+    return response.data
+
+@st.cache_data(ttl=3600, show_spinner=False, max_entries=20)
+def get_document_content(doc_id):
+    """Fetches the processed text of one document (used by the download button)"""
+    supabase = get_supabase()
+    if not supabase:
+        return ""
+    response = supabase.table("documents").select("content, content_url").eq("id", doc_id).execute()
+    if not response.data:
+        return ""
+    return read_document_text(response.data[0])
+
+def get_cached_descriptions(image_hashes):
+    """Looks up vision descriptions by image SHA-256, CACHE_LOOKUP_BATCH hashes per query. Returns {hash: description}"""
+    supabase = get_supabase()
+    if not supabase or not image_hashes:
+        return {}
+
+    # REQUIRED SQL SETUP IN SUPABASE:
+    # CREATE TABLE vision_cache (
+    #   hash TEXT PRIMARY KEY,
+    #   description TEXT,
+    #   created_at TIMESTAMPTZ DEFAULT NOW()
+    # );
+
+    image_hashes = list(image_hashes)
+    found = {}
+    for start in range(0, len(image_hashes), CACHE_LOOKUP_BATCH):
+        batch = image_hashes[start:start + CACHE_LOOKUP_BATCH]
+        try:
+            response = supabase.table("vision_cache").select("hash, description").in_("hash", batch).execute()
+            found.update({row["hash"]: row["description"] for row in response.data if row.get("description")})
+        except Exception as e:
+            # Cache is best-effort; a miss just means we ask Groq (and one bad batch doesn't void the others)
+            print(f"Vision cache lookup warning: {e}")
+    return found
+
+def save_cached_descriptions(descriptions):
+    """Stores successful vision descriptions ({hash: description}) for reuse across uploads, in one upsert"""
+    supabase = get_supabase()
+    if not supabase or not descriptions:
+        return
     try:
-        # Fetch everything, limit to last 50
-        response = supabase.table("documents").select("*").order("created_at", desc=True).limit(50).execute()
-        return response.data
+        rows = [{"hash": image_hash, "description": description} for image_hash, description in descriptions.items()]
+        supabase.table("vision_cache").upsert(rows).execute()
     except Exception as e:
-        return []
+        print(f"Vision cache save warning: {e}")
 
 # --- PROCESSING LOGIC ---
 
@@ -155,13 +353,9 @@ def upload_image_to_storage(image_bytes, filename):
         return "https://placeholder.url/credentials_missing.png"
 
     url = f"{SUPABASE_URL}/storage/v1/object/{SUPABASE_BUCKET}/{filename}"
-    headers = {
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "image/png"
-    }
     
     try:
-        response = requests.post(url, data=image_bytes, headers=headers)
+        response = get_storage_session().post(url, data=image_bytes, headers={"Content-Type": "image/png"}, timeout=30)
         # Check success (200) or duplicate (409)
         final_url = f"{SUPABASE_URL}/storage/v1/object/public/{SUPABASE_BUCKET}/{filename}"
         if response.status_code == 200 or response.status_code == 409 or "Duplicate" in response.text:
@@ -170,71 +364,317 @@ def upload_image_to_storage(image_bytes, filename):
     except:
         return "https://placeholder.url/error.png"
 
-def analyze_image_groq(image_bytes):
+def shrink_for_vision(image_bytes):
+    """Downscales to VISION_MAX_EDGE and re-encodes as JPEG for the Groq payload.
+    Returns (bytes-like, mime). Storage keeps the original full-res bytes."""
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+        original_format = img.format
+        resized = max(img.size) > VISION_MAX_EDGE
+        img.thumbnail((VISION_MAX_EDGE, VISION_MAX_EDGE), Image.LANCZOS)
+
+        # Flatten transparency onto white, otherwise dark-on-transparent diagrams go black
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+
+        # Small line-art PNGs can come out bigger as JPEG - keep whichever is smaller
+        if not resized and original_format in ("PNG", "JPEG") and buf.tell() >= len(image_bytes):
+            return image_bytes, f"image/{original_format.lower()}"
+        # getbuffer() is a view on the JPEG, so b64encode reads it without another copy
+        return buf.getbuffer(), "image/jpeg"
+    except Exception:
+        # Format Pillow can't read (e.g. JBIG2/JPX) - send as-is
+        return image_bytes, "image/png"
+
+def build_vision_request(image_bytes):
+    """Chat-completion body for one image (shared by the sync and batch paths)"""
+    image_bytes, mime = shrink_for_vision(image_bytes)
+    # Encode straight into the final data URL: ASCII decode is the fast path, and no
+    # separate base64 string is kept around next to the URL
+    data_url = (f"data:{mime};base64,".encode("ascii") + base64.b64encode(image_bytes)).decode("ascii")
+    del image_bytes
+    prompt = "Analyze this pharmacy slide image. Transcribe tables to markdown. Describe diagrams/pathways in detail. Transcribe text exactly. Return ONLY content."
+
+    return {
+        "model": VISION_MODEL,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": data_url}},
+            ],
+        }],
+        "max_tokens": 1024,
+        "temperature": 0.1,
+    }
+
+def fill_cached_descriptions(jobs):
+    """Fills job["desc"] from the process memo, then one vision_cache query for the rest.
+    Returns the jobs that still need a vision call."""
+    image_hashes = {job["hash"] for job in jobs}
+    known = recall_descriptions(image_hashes)
+    fetched = get_cached_descriptions(image_hashes - known.keys())
+    memoise_descriptions(fetched)
+    known.update(fetched)
+    for job in jobs:
+        if job["hash"] in known:
+            job["desc"] = known[job["hash"]]
+    return [job for job in jobs if "desc" not in job]
+
+def remember_descriptions(jobs):
+    """Memoises the jobs' new descriptions and saves them in one upsert. Errors are skipped so they get retried."""
+    fresh = {job["hash"]: job["desc"] for job in jobs if not job["desc"].startswith("[Vision Error")}
+    memoise_descriptions(fresh)
+    save_cached_descriptions(fresh)
+
+async def analyze_image_groq(groq_client, image_bytes):
     """Vision Pass using Groq"""
     try:
-        base64_image = base64.b64encode(image_bytes).decode('utf-8')
-        prompt = "Analyze this pharmacy slide image. Transcribe tables to markdown. Describe diagrams/pathways in detail. Transcribe text exactly. Return ONLY content."
-        
-        response = groq_client.chat.completions.create(
-            model="meta-llama/llama-4-scout-17b-16e-instruct", 
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}"}},
-                ],
-            }],
-            max_tokens=1024,
-            temperature=0.1,
-        )
+        # Resize/encode is CPU work, keep it off the event loop
+        request = await asyncio.to_thread(build_vision_request, image_bytes)
+        response = await groq_client.chat.completions.create(**request)
         return response.choices[0].message.content.strip()
     except Exception as e:
         return f"[Vision Error: {str(e)}]"
 
+def analyze_images_groq_batch(jobs):
+    """Vision Pass via the Groq Batch API (cheaper, but can take a while).
+    Fills job["desc"] for every job, keyed back by custom_id."""
+    # Anything we've described before comes straight from the cache
+    jobs = fill_cached_descriptions(jobs)
+    if not jobs:
+        return
+
+    by_id = {f"p{job['page']}_i{job['num']}": job for job in jobs}
+
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_vision_request(job["img_bytes"]),
+        })
+        for custom_id, job in by_id.items()
+    ]
+
+    groq_client = get_groq()
+    with st.status(f"Submitting {len(jobs)} images to Groq batch...", expanded=False) as status:
+        try:
+            batch_file = groq_client.files.create(
+                file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch",
+            )
+            batch = groq_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
+
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                status.update(label=f"Groq batch {batch.status}... (checking every {BATCH_POLL_SECONDS}s)")
+                time.sleep(BATCH_POLL_SECONDS)
+                batch = groq_client.batches.retrieve(batch.id)
+
+            if batch.status != "completed":
+                raise RuntimeError(f"batch {batch.status}")
+
+            # Successful requests land in output_file_id, failed ones in error_file_id
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                for line in groq_client.files.content(file_id).text().splitlines():
+                    if not line.strip():
+                        continue
+                    result = json.loads(line)
+                    job = by_id.get(result.get("custom_id"))
+                    if job is None:
+                        continue
+                    response = result.get("response") or {}
+                    if response.get("status_code") == 200:
+                        job["desc"] = response["body"]["choices"][0]["message"]["content"].strip()
+                    else:
+                        error = result.get("error") or response.get("body")
+                        job["desc"] = f"[Vision Error: {error}]"
+
+            status.update(label="Groq batch complete!", state="complete")
+        except Exception as e:
+            status.update(label=f"Groq batch error: {e}", state="error")
+            for job in jobs:
+                job.setdefault("desc", f"[Vision Error: {str(e)}]")
+
+    for job in jobs:
+        job.setdefault("desc", "[Vision Error: missing from batch output]")
+    remember_descriptions(jobs)
+
+async def run_vision(jobs, upload_executor, groq_client):
+    """Uploads + describes all image jobs concurrently (bounded by VISION_CONCURRENCY).
+    Each job uploads its full-res image while the downscaled copy is described, then drops the bytes.
+    Jobs that already have a "desc" (cache hits) are only uploaded."""
+    sem = asyncio.Semaphore(VISION_CONCURRENCY)
+
+    async def one(slot, job):
+        # Stagger the first wave so we don't encode/send everything at once
+        await asyncio.sleep(min(slot, VISION_CONCURRENCY) * VISION_STAGGER_SECONDS)
+        async with sem:
+            img_bytes = job.pop("img_bytes")
+            url_future = asyncio.wrap_future(upload_executor.submit(upload_image_to_storage, img_bytes, job["fname"]))
+            if "desc" not in job:
+                job["desc"] = await analyze_image_groq(groq_client, img_bytes)
+            del img_bytes
+            job["url"] = await url_future
+
+    await asyncio.gather(*(one(slot, job) for slot, job in enumerate(jobs)))
+
+def spool_upload_to_disk(uploaded_file):
+    """Copies the upload to a temp PDF in chunks and returns its path.
+    MuPDF then reads pages from disk instead of us holding another full copy in memory."""
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        try:
+            shutil.copyfileobj(uploaded_file, tmp, UPLOAD_SPOOL_CHUNK)
+        except BaseException:
+            # The caller's cleanup only covers a path we returned, so don't leave a partial PDF in /tmp
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        return tmp.name
+
+def extract_pdf_pages(pdf_path, prog_bar, status_txt):
+    """Phase 1: per-page text + image extraction (CPU-bound).
+    The first pages are timed in-process; if the rest would take over PARALLEL_MIN_SECONDS,
+    it's split into page ranges across worker processes. Results come back in page order."""
+    pages = []
+    decoded = {} # xref -> image part, shared across pages
+    with fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+        workers = min(os.cpu_count() or 1, EXTRACT_MAX_WORKERS)
+        started = time.perf_counter()
+
+        for i, page in enumerate(doc):
+            if workers > 1 and i == PARALLEL_SAMPLE_PAGES:
+                per_page = (time.perf_counter() - started) / i
+                if per_page * (total_pages - i) > PARALLEL_MIN_SECONDS:
+                    break
+            prog_bar.progress((i + 1) / total_pages)
+            status_txt.text(f"Processing Page {i+1}/{total_pages}...")
+            pages.append(extract_page(page, decoded))
+
+    if len(pages) == total_pages:
+        return pages
+
+    # Several small ranges per worker so the progress bar moves and slow pages balance out
+    first = len(pages)
+    chunk = max(1, (total_pages - first) // (workers * 4))
+    ranges = [(start, min(start + chunk, total_pages)) for start in range(first, total_pages, chunk)]
+    results = {}
+    done = first
+
+    # spawn, not fork: forking the Streamlit server (threads, sockets) isn't safe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(extract_page_range, pdf_path, start, end): start for start, end in ranges}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            done += len(results[futures[future]])
+            prog_bar.progress(done / total_pages)
+            status_txt.text(f"Processing Page {done}/{total_pages}...")
+
+    return pages + [page for start in sorted(results) for page in results[start]]
+
 def process_pdf_file(uploaded_file):
-    doc = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-    full_content = ""
-    image_count = 0
-    
     prog_bar = st.progress(0)
     status_txt = st.empty()
-    
-    total_pages = len(doc)
-    
-    for i, page in enumerate(doc):
-        prog_bar.progress((i + 1) / total_pages)
-        status_txt.text(f"Processing Page {i+1}/{total_pages}...")
-        
-        blocks = page.get_text("dict")["blocks"]
-        blocks.sort(key=lambda b: b["bbox"][1])
 
-        for block in blocks:
-            if block["type"] == 0: # Text
-                text = " ".join([span["text"] for line in block["lines"] for span in line["spans"]])
-                if text.strip(): full_content += text.strip() + "\n\n"
-            
-            elif block["type"] == 1: # Image
-                image_count += 1
-                img_bytes = block["image"]
-                if len(img_bytes) < 2048: continue
-                
-                clean_name = uploaded_file.name.split('.')[0].replace(" ", "_")
-                fname = f"doc_{clean_name}_p{i}_img{image_count}.{block['ext']}"
-                
-                pub_url = upload_image_to_storage(img_bytes, fname)
-                desc = analyze_image_groq(img_bytes)
-                
-                # Clean up description
-                clean_desc = desc.replace('"', "'")
-                token = f"\n<<SLIDE_IMAGE: url=\"{pub_url}\" caption=\"Img {image_count} (Page {i+1})\" context=\"{clean_desc}\">>\n"
-                
-                full_content += token + "\n"
-                time.sleep(1.0) # Rate limit safety
+    groq_client = get_async_groq()
+    if groq_client and not BATCH_MODE:
+        # Runs on the vision loop in the background while we extract, on the same pool the fan-out uses
+        asyncio.run_coroutine_threadsafe(warm_up_groq(groq_client), get_vision_loop())
+
+    pdf_path = spool_upload_to_disk(uploaded_file)
+    try:
+        pages = extract_pdf_pages(pdf_path, prog_bar, status_txt)
+    finally:
+        os.remove(pdf_path)
+
+    total_pages = len(pages)
+    clean_name = uploaded_file.name.split('.')[0].replace(" ", "_")
+    image_count = 0
+
+    # parts holds plain text strings and image job dicts, in document order
+    parts = []
+    jobs = []
+    seen = {} # image hash -> first job with those bytes
+
+    for i, page_parts in enumerate(pages):
+        for part in page_parts:
+            if isinstance(part, str):
+                parts.append(part)
+                continue
+
+            image_count += 1
+            if part["image"] is None: continue
+
+            job = {
+                "page": i,
+                "num": image_count,
+                "hash": part["hash"],
+            }
+
+            # Same image again (logo, repeated diagram)? Reuse the first one's upload + description
+            original = seen.get(job["hash"])
+            if original:
+                job["same_as"] = original
+            else:
+                job["img_bytes"] = part["image"]
+                job["ext"] = part["ext"]
+                job["fname"] = f"doc_{clean_name}_p{i}_img{image_count}.{part['ext']}"
+                seen[job["hash"]] = job
+                jobs.append(job)
+            parts.append(job)
+    del pages
+
+    # Phase 2: network-bound vision + upload calls, run concurrently
+    if jobs:
+        status_txt.text(f"Analyzing {len(jobs)} images...")
+        with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+            if BATCH_MODE:
+                # Uploads go out in the background while the batch runs
+                urls = executor.map(lambda job: upload_image_to_storage(job["img_bytes"], job["fname"]), jobs)
+                analyze_images_groq_batch(jobs)
+                for job, url in zip(jobs, urls):
+                    job["url"] = url
+                    del job["img_bytes"]
+            else:
+                # One vision_cache lookup and one save for the whole deck, not a round trip each per image
+                pending = fill_cached_descriptions(jobs)
+                vision = run_vision(jobs, executor, groq_client)
+                asyncio.run_coroutine_threadsafe(vision, get_vision_loop()).result()
+                remember_descriptions(pending)
+
+    # Write into one buffer rather than growing a str with += (quadratic on big decks)
+    buf = io.StringIO()
+    for part in parts:
+        if isinstance(part, str):
+            buf.write(part)
+            continue
+
+        source = part.get("same_as", part)
+
+        # Clean up description
+        clean_desc = source["desc"].replace('"', "'")
+        token = f"\n<<SLIDE_IMAGE: url=\"{source['url']}\" caption=\"Img {part['num']} (Page {part['page']+1})\" context=\"{clean_desc}\">>\n"
+        
+        buf.write(token + "\n")
 
     prog_bar.progress(100)
     status_txt.text("Done!")
-    return full_content
+    image_urls = [job["url"] for job in jobs]
+    return buf.getvalue(), total_pages, image_urls
 
 # --- UI LAYOUT ---
 
@@ -269,23 +709,36 @@ with col1:
         uploaded_file = st.file_uploader("Drop PDF here", type=["pdf"])
 
         if uploaded_file and st.button("Start Processing", type="primary"):
+            # Hash the upload in place (getbuffer is a view, no copy) so a second click on the same file is a no-op
+            file_key = f"{hashlib.sha256(uploaded_file.getbuffer()).hexdigest()}:{subject_tag}"
+
             if not GROQ_API_KEY:
                 st.error("Missing Groq API Key in Secrets.")
+            elif st.session_state.get("processed_file_hash") == file_key:
+                st.info("This file has already been processed. Download the result below.")
             else:
                 with st.spinner("Processing... this may take a minute."):
-                    processed_text = process_pdf_file(uploaded_file)
+                    processed_text, page_count, image_urls = process_pdf_file(uploaded_file)
                     
                     if processed_text:
-                        st.success("Processing Complete!")
-                        
-                        # Log to DB (Now saving content!)
-                        log_upload_to_db(uploaded_file.name, subject_tag, processed_text)
-                        
-                        out_name = uploaded_file.name.replace(".pdf", "_processed.txt")
-                        st.download_button("📥 Download Result", processed_text, file_name=out_name)
-                        
-                        time.sleep(1) # Give db a moment
-                        st.rerun()
+                        # Keep the result across reruns so the download below doesn't need a re-process
+                        st.session_state["last_result"] = {"name": uploaded_file.name, "text": processed_text}
+
+                        # Failed descriptions stay out of the library; a retry only redoes those (the rest are cached)
+                        vision_errors = processed_text.count("[Vision Error")
+                        if vision_errors:
+                            st.warning(f"{vision_errors} image(s) could not be described, so this wasn't saved to the library. Press Start Processing to retry.")
+                        elif log_upload_to_db(uploaded_file.name, subject_tag, processed_text, page_count, image_urls):
+                            # Only a saved upload counts as done; otherwise the button stays available to retry
+                            st.session_state["processed_file_hash"] = file_key
+                            time.sleep(1) # Give db a moment
+                            st.rerun()
+
+        if "last_result" in st.session_state:
+            last_result = st.session_state["last_result"]
+            st.success(f"Processing Complete! ({last_result['name']})")
+            out_name = last_result["name"].replace(".pdf", "_processed.txt")
+            st.download_button("📥 Download Result", last_result["text"], file_name=out_name, on_click="ignore")
 
 # --- RIGHT COLUMN: HISTORY (Custom UI) ---
 with col2:
@@ -294,43 +747,61 @@ with col2:
         h1, h2 = st.columns([4, 1])
         h1.subheader("📚 Library History")
         if h2.button("🔄"):
+            get_upload_history.clear()
             st.rerun()
 
-        history_data = get_upload_history()
+        try:
+            history_data = get_upload_history()
+        except Exception as e:
+            # A blip isn't cached, so the next rerun (or 🔄) tries again
+            st.error(f"Could not load library: {e}")
+            history_data = None
         
         if history_data:
+            # Checkbox state from the previous run tells us what's ticked
+            selected = [doc['id'] for doc in history_data if st.session_state.get(f"sel_{doc['id']}")]
+            if selected and st.button(f"🗑️ Delete selected ({len(selected)})", type="primary"):
+                delete_documents(selected)
+                for doc_id in selected:
+                    del st.session_state[f"sel_{doc_id}"]
+                time.sleep(0.5)
+                st.rerun()
+
             for doc in history_data:
                 # Create a card-like container for each file
                 with st.container(border=True):
-                    # Layout: Info (Left) | Download (Right) | Delete (Far Right)
-                    c_info, c_down, c_del = st.columns([4, 1, 0.5])
+                    # Layout: Select | Info (Left) | Download (Right) | Delete (Far Right)
+                    c_sel, c_info, c_down, c_del = st.columns([0.3, 4, 1, 0.5])
+
+                    with c_sel:
+                        st.checkbox("Select", key=f"sel_{doc['id']}", label_visibility="collapsed")
                     
                     with c_info:
                         st.markdown(f"**{doc.get('filename', 'Unknown File')}**")
                         # Format date nicely
                         raw_date = doc.get('created_at', '')
                         display_date = raw_date[:10] if raw_date else "Unknown Date"
-                        st.caption(f"🏷️ {doc.get('subject', 'General')} • 📅 {display_date}")
+                        caption = f"🏷️ {doc.get('subject', 'General')} • 📅 {display_date}"
+                        if doc.get('page_count'):
+                            caption += f" • 📄 {doc['page_count']} pages"
+                        st.caption(caption)
                     
                     with c_down:
-                        # Only show download button if content exists
-                        content = doc.get('content', '')
-                        if content:
-                            dl_name = doc.get('filename', 'doc.pdf').replace(".pdf", ".txt")
-                            st.download_button(
-                                "📥", 
-                                data=content, 
-                                file_name=dl_name,
-                                key=f"dl_{doc['id']}",
-                                help="Download processed text"
-                            )
-                        else:
-                            st.caption("No content")
+                        # Content is only fetched when the button is actually clicked
+                        dl_name = (doc.get('filename') or 'doc.pdf').replace(".pdf", ".txt")
+                        st.download_button(
+                            "📥", 
+                            data=functools.partial(get_document_content, doc['id']), 
+                            file_name=dl_name,
+                            key=f"dl_{doc['id']}",
+                            help="Download processed text",
+                            on_click="ignore"
+                        )
 
                     with c_del:
                         if st.button("🗑️", key=f"del_{doc['id']}", help="Delete permanently"):
-                            delete_document(doc['id'])
+                            delete_documents([doc['id']])
                             time.sleep(0.5)
                             st.rerun()
-        else:
+        elif history_data is not None:
             st.info("No documents found in database.")
@@ -0,0 +1,131 @@
+"""PyMuPDF extraction for the ingestion app.
+
+Kept free of Streamlit (and anything else heavy) so the worker processes
+used for large decks can import it cheaply.
+"""
+import hashlib
+import io
+import fitz  # PyMuPDF
+from PIL import Image, ImageStat
+
+MIN_IMAGE_BYTES = 2048 # anything smaller is an icon/bullet, not worth a vision call
+
+# Decoration filter: images failing any of these never get a vision call
+MIN_IMAGE_EDGE = 64 # px, shortest side
+MAX_ASPECT_RATIO = 6 # banners, rules, separators
+MIN_GRAY_STDDEV = 10 # near-flat colour (backgrounds, blank panels)
+
+# get_text("dict") without image blocks, so it doesn't decode every picture on the page
+TEXT_ONLY_DICT_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# "blocks" with a placeholder block per image: nothing is decoded, and unlike
+# get_images() it also sees inline (BI/EI) images written into the content stream
+BLOCKS_WITH_IMAGES_FLAGS = fitz.TEXTFLAGS_BLOCKS | fitz.TEXT_PRESERVE_IMAGES
+
+def is_informative(img_bytes):
+    """Cheap pre-vision check: False for decoration (tiny, banner-shaped or near-flat).
+    Images Pillow can't read are assumed informative."""
+    try:
+        img = Image.open(io.BytesIO(img_bytes))
+        w, h = img.size
+        if min(w, h) < MIN_IMAGE_EDGE or max(w, h) / min(w, h) > MAX_ASPECT_RATIO:
+            return False
+
+        # Downscaling only lowers the spread, so a thumbnail that passes settles it cheaply
+        small = Image.open(io.BytesIO(img_bytes))
+        small.draft("L", (256, 256)) # JPEG decoders can skip straight to a small grayscale
+        small.thumbnail((256, 256))
+        if ImageStat.Stat(small.convert("L")).stddev[0] >= MIN_GRAY_STDDEV:
+            return True
+
+        # One that fails may be thin line art (structures, graphs) blurred away: re-check at full size
+        img.draft("L", img.size) # JPEG: decode just the luma, no downscale
+        return ImageStat.Stat(img.convert("L")).stddev[0] >= MIN_GRAY_STDDEV
+    except Exception:
+        return True
+
+def clean_text(text):
+    """Collapses line breaks and runs of spaces to single spaces, so both extraction paths format text the same"""
+    return " ".join(text.split())
+
+def image_part(img_bytes, ext):
+    """Image dict for extract_page, or {"image": None} if it's too small or decorative"""
+    if len(img_bytes) < MIN_IMAGE_BYTES:
+        return {"image": None}
+
+    if not is_informative(img_bytes):
+        return {"image": None}
+
+    return {
+        "image": img_bytes,
+        "ext": ext,
+        "hash": hashlib.sha256(img_bytes).hexdigest(),
+    }
+
+def extract_page(page, decoded=None):
+    """Returns one page's content in reading order: text strings (ending in a blank line)
+    and image dicts {"image", "ext", "hash"}. Images under MIN_IMAGE_BYTES or
+    judged decorative keep their place (they still count towards image numbering)
+    but carry image=None.
+
+    decoded caches image parts by xref; pass the same dict for every page of a
+    document so an image reused across slides (logos, templates) is only extracted once."""
+    parts = []
+
+    blocks = page.get_text("blocks", flags=BLOCKS_WITH_IMAGES_FLAGS)
+    if not any(b[6] == 1 for b in blocks):
+        # Text-only page: plain "blocks" mode is enough, skip building the full span/font dict
+        blocks.sort(key=lambda b: b[1])
+        for block in blocks:
+            text = clean_text(block[4])
+            if text: parts.append(text + "\n\n")
+        return parts
+
+    # Image placements straight from the xref table: (xref, smask, width, height, ...) plus where it's drawn.
+    # get_image_info(xrefs=True) would render a pixmap of every image just to match it to its xref.
+    placements = []
+    for item in page.get_images(full=True):
+        bbox = page.get_image_bbox(item) * page.derotation_matrix # same unrotated coords as get_text
+        if bbox.is_empty or bbox.is_infinite:
+            continue # listed in the resources but never drawn
+        placements.append({"type": 1, "bbox": tuple(bbox), "xref": item[0], "width": item[2], "height": item[3]})
+
+    if len(placements) != sum(b[6] == 1 for b in blocks):
+        # Inline images (no xref) or one image drawn twice: let the dict decode everything
+        blocks = page.get_text("dict")["blocks"]
+    else:
+        # Text from the dict, images only as position + size metadata: nothing is decoded yet
+        blocks = page.get_text("dict", flags=TEXT_ONLY_DICT_FLAGS)["blocks"] + placements
+    blocks.sort(key=lambda b: b["bbox"][1])
+
+    if decoded is None:
+        decoded = {}
+
+    for block in blocks:
+        if block["type"] == 0: # Text
+            # Spans split a line wherever the style changes (even mid-word), so join them as-is, like "blocks" does
+            text = clean_text("\n".join("".join(span["text"] for span in line["spans"]) for line in block["lines"]))
+            if text: parts.append(text + "\n\n")
+
+        elif block["type"] == 1: # Image
+            if "image" in block:
+                parts.append(image_part(block["image"], block["ext"]))
+                continue
+
+            xref = block["xref"]
+            if xref not in decoded:
+                if min(block["width"], block["height"]) < MIN_IMAGE_EDGE:
+                    # Icon-sized going by the metadata: skip without decoding it at all
+                    decoded[xref] = {"image": None}
+                else:
+                    extracted = page.parent.extract_image(xref)
+                    decoded[xref] = image_part(extracted["image"], extracted["ext"]) if extracted else {"image": None}
+            parts.append(decoded[xref])
+
+    return parts
+
+def extract_page_range(pdf_path, start, end):
+    """Worker entry point: opens the PDF itself and extracts pages [start, end)"""
+    decoded = {}
+    with fitz.open(pdf_path) as doc:
+        return [extract_page(doc[i], decoded) for i in range(start, end)]
@@ -0,0 +1,57 @@
+"""Checks for the pre-vision image filter. Run with: python -m unittest"""
+import io
+import math
+import unittest
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageDraw
+
+from pdf_extract import extract_page, is_informative
+
+def encode(img, fmt):
+    buf = io.BytesIO()
+    img.save(buf, fmt)
+    return buf.getvalue()
+
+def ring_structure(size, line_width):
+    """Two fused hexagons plus a side chain in thin black lines on white, like a drawn chemical structure"""
+    w, h = size
+    img = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(img)
+    r = min(w, h) / 8
+    for cx in (w / 2 - r * 0.87, w / 2 + r * 0.87):
+        points = [(cx + r * math.cos(math.pi / 6 + k * math.pi / 3), h / 2 + r * math.sin(math.pi / 6 + k * math.pi / 3)) for k in range(7)]
+        draw.line(points, fill="black", width=line_width)
+    draw.line([(w / 2 + r * 1.7, h / 2), (w / 2 + r * 2.6, h / 2 - r * 0.5)], fill="black", width=line_width)
+    return img
+
+class IsInformativeTest(unittest.TestCase):
+    def test_high_res_line_art_is_kept(self):
+        # These fall under MIN_GRAY_STDDEV once thumbnailed, but not at full resolution
+        for size, line_width in (((1600, 1200), 4), ((2400, 1800), 3), ((1000, 1000), 2)):
+            for fmt in ("PNG", "JPEG"):
+                with self.subTest(size=size, line_width=line_width, fmt=fmt):
+                    self.assertTrue(is_informative(encode(ring_structure(size, line_width), fmt)))
+
+    def test_flat_panel_is_dropped(self):
+        self.assertFalse(is_informative(encode(Image.new("RGB", (1600, 1200), (240, 240, 245)), "PNG")))
+
+    def test_banner_is_dropped(self):
+        self.assertFalse(is_informative(encode(ring_structure((2000, 200), 4), "PNG")))
+
+class ExtractPageTest(unittest.TestCase):
+    def test_text_is_the_same_with_or_without_an_image(self):
+        # Pages without images take the "blocks" fast path, pages with one the dict path
+        doc = fitz.open()
+        for with_image in (False, True):
+            page = doc.new_page()
+            page.insert_htmlbox(fitz.Rect(72, 72, 540, 200), "<p>Aspirin is <b>acetylsalicylic</b> acid, an acetyl<i>salicylate</i> ester.</p>")
+            if with_image:
+                page.insert_image(fitz.Rect(72, 300, 372, 500), stream=encode(ring_structure((600, 400), 3), "PNG"))
+
+        texts = [[part for part in extract_page(page) if isinstance(part, str)] for page in doc]
+        self.assertEqual(texts[0], ["Aspirin is acetylsalicylic acid, an acetylsalicylate ester.\n\n"])
+        self.assertEqual(texts[1], texts[0])
+
+if __name__ == "__main__":
+    unittest.main()